@@ -1,15 +1,15 @@
 """
 Database Helper Functions
 
-MongoDB helper functions ready to use in your backend code.
-Import and use these functions in your API endpoints for database operations.
+Async MongoDB (Motor) helper functions ready to use in your backend code.
+Import and await these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
-from typing import Union
+from typing import Iterable, List, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
@@ -22,11 +22,11 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    _client = AsyncIOMotorClient(database_url)
     db = _client[database_name]
 
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -37,13 +37,30 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def create_documents(collection_name: str, items: Iterable[Union[BaseModel, dict]], ordered: bool = True) -> List[str]:
+    """Insert several documents with timestamps in a single round trip"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    docs = []
+    for data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data.copy()
+        data_dict['created_at'] = now
+        data_dict['updated_at'] = now
+        docs.append(data_dict)
+
+    result = await db[collection_name].insert_many(docs, ordered=ordered)
+    return [str(_id) for _id in result.inserted_ids]
+
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -52,4 +69,4 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(None)
@@ -1,14 +1,23 @@
+import asyncio
+import functools
+import logging
 import os
 import random
-import math
+import re
 from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
 from typing import List, Optional, Dict, Any
 
-from fastapi import FastAPI, HTTPException, Query
+import numpy as np
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 
-from database import db, create_document, get_documents
+from database import db, create_document, create_documents, get_documents
 from schemas import (
     Organization, UserRole,
     Patient, TestOrder, Sample, ResultEntry, ValidationRecord, TATRecord,
@@ -19,6 +28,8 @@ from schemas import (
     ComplianceDoc, ChatMessage,
 )
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="Synapsis - LIMS & Supply Chain API")
 
 app.add_middleware(
@@ -30,13 +41,101 @@ app.add_middleware(
 )
 
 
+# ------------- Response Caching -------------
+_CACHE_LOCKS: Dict[Any, asyncio.Lock] = {}
+
+def ttl_cached(name: str, ttl: int, maxsize: int = 128):
+    """Cache an async endpoint's result in-process for `ttl` seconds.
+
+    Keyed by endpoint name + query params. Concurrent misses on the same key
+    wait on a per-key lock so only one caller hits the database (single-flight).
+    """
+    cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            key = (name, tuple(sorted(kwargs.items())))
+            try:
+                return cache[key]
+            except KeyError:
+                pass
+            lock = _CACHE_LOCKS.setdefault(key, asyncio.Lock())
+            async with lock:
+                try:
+                    return cache[key]
+                except KeyError:
+                    pass
+                result = await fn(*args, **kwargs)
+                cache[key] = result
+                return result
+        return wrapper
+    return decorator
+
+def cache_control(max_age: int):
+    """Dependency that lets browsers/CDNs reuse the response for `max_age` seconds"""
+    async def _set_header(response: Response):  # async: runs inline, even on cache hits
+        response.headers["Cache-Control"] = f"public, max-age={max_age}"
+    return _set_header
+
+async def now_utc() -> datetime:
+    """Per-request UTC timestamp (async so FastAPI doesn't hop to the threadpool)"""
+    return datetime.now(timezone.utc)
+
+
+# Cursor batch size for unpaginated list endpoints: one large batch instead of
+# the driver default (101 docs first, then getMore round trips)
+_LIST_BATCH_SIZE = 500
+
+# Indexes backing the hot query predicates: (collection, keys, options)
+_INDEXES = [
+    ("sample", [("barcode", 1)], {"unique": True}),
+    ("sample", [("status", 1), ("ordered_tests.department", 1)], {}),
+    ("resultentry", [("abnormal_flag", 1)], {}),
+    ("resultentry", [("barcode", 1)], {}),
+    ("requisition", [("status", 1)], {}),
+    ("inventoryitem", [("sku", 1)], {"unique": True}),
+    ("inventoryitem", [("qty", 1)], {}),
+    ("shipment", [("po_number", 1)], {}),
+    ("invoice", [("invoice_no", 1)], {"unique": True}),
+    ("invoice", [("status", 1)], {}),
+    ("payment", [("invoice_no", 1)], {}),
+    ("validationrecord", [("barcode", 1)], {}),
+    ("compliancedoc", [("std", 1), ("status", 1)], {}),
+    # seed keys: let concurrent seeders collide on insert instead of duplicating
+    ("product", [("sku", 1)], {"unique": True}),
+    ("compliancedoc", [("title", 1)], {"unique": True}),
+]
+
+async def _create_index(collection: str, keys, options: Dict[str, Any]):
+    try:
+        await db[collection].create_index(keys, **options)
+    except PyMongoError as e:
+        # e.g. pre-existing duplicates block a unique index; keep serving but say so
+        logger.warning("Could not create index %s on %s: %s", keys, collection, e)
+
+async def _build_indexes():
+    # Concurrent, and one call per index so a failing unique index doesn't take its siblings down
+    await asyncio.gather(*(_create_index(c, k, o) for c, k, o in _INDEXES))
+
+_index_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def ensure_indexes():
+    # Build in the background so an unreachable/slow Mongo doesn't hold up startup
+    global _index_task
+    if db is None:
+        return
+    _index_task = asyncio.create_task(_build_indexes())
+
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Synapsis API is running"}
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -49,7 +148,7 @@ def test_database():
         if db is not None:
             response["database"] = "✅ Connected & Working"
             response["connection_status"] = "Connected"
-            response["collections"] = db.list_collection_names()[:20]
+            response["collections"] = (await db.list_collection_names())[:20]
         else:
             response["database"] = "⚠️ Available but not initialized"
     except Exception as e:
@@ -58,21 +157,26 @@ def test_database():
 
 
 # ------------- Schema Introspection -------------
-@app.get("/schema")
-def get_schema():
-    # Expose Pydantic model JSON schemas for viewer/tools
-    from pydantic import BaseModel as _BM
+def _build_schema_map() -> Dict[str, Any]:
     import schemas as s
 
     model_map = {}
     for name in dir(s):
         obj = getattr(s, name)
-        if isinstance(obj, type) and issubclass(obj, _BM) and obj is not _BM:
+        if isinstance(obj, type) and issubclass(obj, BaseModel) and obj is not BaseModel:
             try:
                 model_map[name] = obj.model_json_schema()
             except Exception:
                 pass
-    return {"models": model_map}
+    return model_map
+
+# Models are static, so their JSON schemas are generated once at import
+_SCHEMA_CACHE = _build_schema_map()
+
+@app.get("/schema")
+async def get_schema():
+    # Expose Pydantic model JSON schemas for viewer/tools
+    return {"models": _SCHEMA_CACHE}
 
 
 # ------------- RBAC (Mock) -------------
@@ -80,46 +184,61 @@ class LoginRequest(BaseModel):
     email: str
     role: str
 
+_PERMISSIONS = MappingProxyType({
+    "admin": ("all",),
+    "lab_manager": ("lims", "inventory", "tat", "reports"),
+    "pathologist": ("validation", "reporting"),
+    "technician": ("worksheets", "entry"),
+    "procurement_officer": ("catalog", "requisition", "po"),
+    "finance": ("ap", "payments", "invoices"),
+})
+
 @app.post("/auth/mock-login")
-def mock_login(payload: LoginRequest):
+async def mock_login(payload: LoginRequest):
     role = payload.role.lower()
-    permissions = {
-        "admin": ["all"],
-        "lab_manager": ["lims", "inventory", "tat", "reports"],
-        "pathologist": ["validation", "reporting"],
-        "technician": ["worksheets", "entry"],
-        "procurement_officer": ["catalog", "requisition", "po"],
-        "finance": ["ap", "payments", "invoices"],
-    }.get(role, [])
-    return {"user": payload.email, "role": role, "permissions": permissions}
+    return {"user": payload.email, "role": role, "permissions": list(_PERMISSIONS.get(role, ()))}
 
 
 # ------------- Dashboard -------------
-@app.get("/dashboard/summary")
-def dashboard_summary():
-    # Light aggregation/simulated KPIs + charts
-    reports_to_validate = db["resultentry"].count_documents({"abnormal_flag": {"$in": ["H", "L", "CRIT"]}}) if db else 0
-    pending_reqs = db["requisition"].count_documents({"status": "pending"}) if db else 0
-    low_stock = db["inventoryitem"].count_documents({"qty": {"$lt": 10}}) if db else 0
-    nabl_tasks = db["compliancedoc"].count_documents({"std": "NABL", "status": {"$ne": "complete"}}) if db else 0
-
-    # Simulated 12-month P&L and Spend
+@functools.lru_cache(maxsize=1)
+def _simulate_pnl_spend(day: str):
+    # Simulated 12-month P&L and Spend (cosmetic filler, regenerated once per UTC day)
     months = ["Jan","Feb","Mar","Apr","May","Jun","Jul","Aug","Sep","Oct","Nov","Dec"]
-    pnl = []
-    spend = []
-    base_rev = 120000
-    base_cost = 70000
-    for i, m in enumerate(months, start=1):
-        revenue = base_rev + random.randint(-10000, 15000)
-        cost = base_cost + random.randint(-8000, 12000)
-        pnl.append({"month": m, "revenue": revenue, "cost": cost, "profit": revenue - cost})
-        spend.append({"month": m, "reagents": random.randint(15000, 30000), "consumables": random.randint(5000, 15000), "logistics": random.randint(3000, 10000)})
+    n = len(months)
+    rng = np.random.default_rng()
+    # upper bounds are exclusive in Generator.integers
+    revenue = (120000 + rng.integers(-10000, 15001, n)).tolist()
+    cost = (70000 + rng.integers(-8000, 12001, n)).tolist()
+    reagents = rng.integers(15000, 30001, n).tolist()
+    consumables = rng.integers(5000, 15001, n).tolist()
+    logistics = rng.integers(3000, 10001, n).tolist()
+    pnl = [{"month": m, "revenue": r, "cost": c, "profit": r - c} for m, r, c in zip(months, revenue, cost)]
+    spend = [
+        {"month": m, "reagents": rg, "consumables": cs, "logistics": lg}
+        for m, rg, cs, lg in zip(months, reagents, consumables, logistics)
+    ]
+    return pnl, spend
+
+@app.get("/dashboard/summary", dependencies=[Depends(cache_control(60))])
+@ttl_cached("dashboard_summary", ttl=60)
+async def dashboard_summary():
+    # Independent counts fan out concurrently; wall-clock is the slowest single count
+    if db is not None:
+        reports_to_validate, pending_reqs, low_stock_count, nabl_tasks = await asyncio.gather(
+            db["resultentry"].count_documents({"abnormal_flag": {"$in": ["H", "L", "CRIT"]}}),
+            db["requisition"].count_documents({"status": "pending"}),
+            db["inventoryitem"].count_documents({"qty": {"$lt": 10}}),
+            db["compliancedoc"].count_documents({"std": "NABL", "status": {"$ne": "complete"}}),
+        )
+    else:
+        reports_to_validate = pending_reqs = low_stock_count = nabl_tasks = 0
+    pnl, spend = _simulate_pnl_spend(datetime.now(timezone.utc).date().isoformat())
 
     return {
         "cards": {
             "reports_to_validate": reports_to_validate,
             "pending_requisitions": pending_reqs,
-            "low_stock": low_stock,
+            "low_stock": low_stock_count,
             "nabl_compliance_pending": nabl_tasks,
         },
         "pnl": pnl,
@@ -129,10 +248,13 @@ def dashboard_summary():
 
 # ------------- LIMS -------------
 @app.post("/lims/sample/receive")
-def receive_sample(sample: Sample):
-    sample.received_at = datetime.now(timezone.utc)
+async def receive_sample(sample: Sample, now: datetime = Depends(now_utc)):
+    sample.received_at = now
     sample.status = "received" if not sample.rejection_reason else "rejected"
-    sid = create_document("sample", sample)
+    try:
+        sid = await create_document("sample", sample)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Sample with this barcode already received")
     return {"id": sid, "status": sample.status}
 
 class RejectRequest(BaseModel):
@@ -140,27 +262,36 @@ class RejectRequest(BaseModel):
     reason: str
 
 @app.post("/lims/sample/reject")
-def reject_sample(req: RejectRequest):
+async def reject_sample(req: RejectRequest, now: datetime = Depends(now_utc)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    res = db["sample"].update_one({"barcode": req.barcode}, {"$set": {"status": "rejected", "rejection_reason": req.reason, "updated_at": datetime.now(timezone.utc)}})
+    res = await db["sample"].update_one({"barcode": req.barcode}, {"$set": {"status": "rejected", "rejection_reason": req.reason, "updated_at": now}})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Sample not found")
     return {"barcode": req.barcode, "status": "rejected"}
 
+_WORKSHEET_FIELDS = {"_id": 0, "barcode": 1, "patient": 1, "ordered_tests": 1, "status": 1, "received_at": 1}
+
 @app.get("/lims/worksheets")
-def worksheets(department: Optional[str] = Query(None)):
+async def worksheets(
+    department: Optional[str] = Query(None),
+    limit: int = Query(100, ge=1, le=500),
+    skip: int = Query(0, ge=0),
+):
     if db is None:
         return {"items": []}
     q: Dict[str, Any] = {}
     if department:
         q["ordered_tests.department"] = department
     q["status"] = {"$in": ["received", "in_progress"]}
-    items = list(db["sample"].find(q, {"_id": 0}))
+    # stable order so skip/limit pages neither repeat nor drop rows
+    items = await db["sample"].find(q, _WORKSHEET_FIELDS).sort([("received_at", 1), ("_id", 1)]).skip(skip).limit(limit).batch_size(limit).to_list(None)
     return {"items": items}
 
 @app.post("/lims/result")
-def add_result(entry: ResultEntry):
+async def add_result(entry: ResultEntry, now: datetime = Depends(now_utc)):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
     # derive abnormal flag
     flag = None
     if entry.ref_low is not None and entry.value < entry.ref_low:
@@ -169,18 +300,25 @@ def add_result(entry: ResultEntry):
         flag = "H"
     if flag is not None:
         entry.abnormal_flag = flag
-    entry.entered_at = datetime.now(timezone.utc)
-    rid = create_document("resultentry", entry)
-    # mark sample in_progress
-    if db is not None:
-        db["sample"].update_one({"barcode": entry.barcode}, {"$set": {"status": "in_progress", "updated_at": datetime.now(timezone.utc)}})
+    entry.entered_at = now
+    rid = await create_document("resultentry", entry)
+    # mark sample in_progress only once the result is stored
+    await db["sample"].update_one({"barcode": entry.barcode}, {"$set": {"status": "in_progress", "updated_at": entry.entered_at}})
     return {"id": rid, "flag": entry.abnormal_flag}
 
+_VALIDATION_FIELDS = {
+    "_id": 0, "barcode": 1, "test_code": 1, "parameter": 1, "value": 1, "unit": 1,
+    "ref_low": 1, "ref_high": 1, "abnormal_flag": 1, "entered_at": 1,
+}
+
 @app.get("/lims/validation-queue")
-def validation_queue():
+async def validation_queue(
+    limit: int = Query(200, ge=1, le=500),
+    skip: int = Query(0, ge=0),
+):
     if db is None:
         return {"items": []}
-    items = list(db["resultentry"].find({"abnormal_flag": {"$in": ["H", "L", "CRIT"]}}, {"_id": 0}).limit(200))
+    items = await db["resultentry"].find({"abnormal_flag": {"$in": ["H", "L", "CRIT"]}}, _VALIDATION_FIELDS).sort("_id", 1).skip(skip).limit(limit).batch_size(limit).to_list(None)
     return {"items": items}
 
 class ValidateRequest(BaseModel):
@@ -189,47 +327,68 @@ class ValidateRequest(BaseModel):
     comments: Optional[str] = None
 
 @app.post("/lims/validate")
-def validate_results(req: ValidateRequest):
+async def validate_results(req: ValidateRequest, now: datetime = Depends(now_utc)):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
     record = ValidationRecord(
         barcode=req.barcode,
         reviewed_by=req.reviewed_by,
         comments=req.comments,
-        validated_at=datetime.now(timezone.utc),
+        validated_at=now,
         status="validated",
     )
-    vid = create_document("validationrecord", record)
-    if db is not None:
-        db["sample"].update_one({"barcode": req.barcode}, {"$set": {"status": "validated", "updated_at": datetime.now(timezone.utc)}})
+    vid = await create_document("validationrecord", record)
+    # never mark a sample validated without its validation record
+    await db["sample"].update_one({"barcode": req.barcode}, {"$set": {"status": "validated", "updated_at": record.validated_at}})
     return {"id": vid, "status": "validated"}
 
 @app.get("/lims/tat")
-def tat_overview():
+async def tat_overview():
     if db is None:
         return {"avg_mins": 0, "on_time_pct": 0}
-    records = list(db["validationrecord"].find({}, {"_id": 0, "barcode": 1, "validated_at": 1}))
-    on_time = 0
-    total = 0
-    deltas = []
-    for r in records:
-        s = db["sample"].find_one({"barcode": r["barcode"]}, {"received_at": 1, "ordered_tests": 1, "_id": 0})
-        if not s or not s.get("received_at"):
-            continue
-        # assume target 240 mins default
-        target = 240
-        mins = (r["validated_at"] - s["received_at"]).total_seconds() / 60.0
-        deltas.append(mins)
-        total += 1
-        if mins <= target:
-            on_time += 1
-    avg = sum(deltas) / len(deltas) if deltas else 0
+    # assume target 240 mins default; join + TAT math run server-side in one round trip
+    target = 240
+    pipeline = [
+        {"$lookup": {"from": "sample", "localField": "barcode", "foreignField": "barcode", "as": "s"}},
+        {"$unwind": "$s"},
+        {"$match": {"s.received_at": {"$ne": None}}},
+        {"$project": {"mins": {"$divide": [{"$subtract": ["$validated_at", "$s.received_at"]}, 60000]}}},
+        {"$group": {
+            "_id": None,
+            "avg": {"$avg": "$mins"},
+            "total": {"$sum": 1},
+            "on_time": {"$sum": {"$cond": [{"$lte": ["$mins", target]}, 1, 0]}},
+        }},
+    ]
+    rows = await db["validationrecord"].aggregate(pipeline).to_list(1)
+    stats = rows[0] if rows else {}
+    avg = stats.get("avg") or 0
+    total = stats.get("total", 0)
+    on_time = stats.get("on_time", 0)
     pct = round(100.0 * on_time / total, 2) if total else 0
     return {"avg_mins": round(avg, 1), "on_time_pct": pct}
 
 
 # ------------- Procurement & Catalog -------------
-@app.get("/catalog")
-def get_catalog():
-    items = list(db["product"].find({}, {"_id": 0})) if db else []
+async def _seed_missing(collection: str, key: str, seed: List[BaseModel]):
+    """Insert the seed docs whose `key` value isn't stored yet (one find + one insert_many)"""
+    if db is None:
+        return
+    values = [getattr(d, key) for d in seed]
+    existing = {doc[key] async for doc in db[collection].find({key: {"$in": values}}, {key: 1, "_id": 0})}
+    missing = [d for d in seed if getattr(d, key) not in existing]
+    if missing:
+        try:
+            await create_documents(collection, missing, ordered=False)
+        except BulkWriteError:
+            # a concurrent request seeded some of the same keys first; the unique
+            # index rejected those and ordered=False kept the rest
+            pass
+
+@app.get("/catalog", dependencies=[Depends(cache_control(600))])
+@ttl_cached("catalog", ttl=600)
+async def get_catalog():
+    items = await db["product"].find({}, {"_id": 0}).batch_size(_LIST_BATCH_SIZE).to_list(None) if db is not None else []
     if not items:
         # seed a few items
         seed = [
@@ -240,70 +399,85 @@ def get_catalog():
             Product(sku="CS-VAC-2ML", title="2ml Vacutainer", vendor="HealthSup",
                     specifications="Pack of 100", cold_chain=False, hsn="3926", gst_rate=18.0, category="consumable", price=600.0),
         ]
-        for p in seed:
-            try:
-                create_document("product", p)
-            except Exception:
-                pass
+        await _seed_missing("product", "sku", seed)
         items = [p.model_dump() for p in seed]
     return {"items": items}
 
 @app.post("/requisitions")
-def create_requisition(req: Requisition):
-    rid = create_document("requisition", req)
+async def create_requisition(req: Requisition):
+    rid = await create_document("requisition", req)
     return {"id": rid, "status": req.status}
 
 @app.get("/requisitions")
-def list_requisitions(status: Optional[str] = None):
+async def list_requisitions(status: Optional[str] = None):
     q = {"status": status} if status else {}
-    items = list(db["requisition"].find(q, {"_id": 0})) if db else []
+    items = await db["requisition"].find(q, {"_id": 0}).batch_size(_LIST_BATCH_SIZE).to_list(None) if db is not None else []
     return {"items": items}
 
+def _requisition_oid(req_id: str) -> Optional[ObjectId]:
+    # req_id is the id returned by POST /requisitions; lookups hit the built-in _id index
+    try:
+        return ObjectId(req_id)
+    except (InvalidId, TypeError):
+        return None
+
 class ReqAction(BaseModel):
     req_id: str
     approver: str
     action: str  # approve/reject
     remarks: Optional[str] = None
+    fallback_to_pending: bool = False  # demo mode: act on any pending requisition if req_id is unknown
 
 @app.post("/requisitions/action")
-def req_action(act: ReqAction):
+async def req_action(act: ReqAction, now: datetime = Depends(now_utc)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
     new_status = "approved" if act.action == "approve" else "rejected"
-    res = db["requisition"].update_one({"_id": {"$exists": True}, "req_id": act.req_id}, {"$set": {"status": new_status, "approver": act.approver, "remarks": act.remarks, "updated_at": datetime.now(timezone.utc)}})
-    # If req_id is not stored, update by any with status pending - simple demo approach
-    if res.matched_count == 0:
-        db["requisition"].update_one({"status": "pending"}, {"$set": {"status": new_status, "approver": act.approver, "remarks": act.remarks, "updated_at": datetime.now(timezone.utc)}})
+    update = {"$set": {"status": new_status, "approver": act.approver, "remarks": act.remarks, "updated_at": now}}
+    oid = _requisition_oid(act.req_id)
+    matched = 0
+    if oid is not None:
+        matched = (await db["requisition"].update_one({"_id": oid}, update)).matched_count
+    if matched == 0 and act.fallback_to_pending:
+        matched = (await db["requisition"].update_one({"status": "pending"}, update)).matched_count
+    if matched == 0:
+        raise HTTPException(status_code=404, detail="Requisition not found")
     return {"status": new_status}
 
 class POCreate(BaseModel):
     req_id: str
     po_number: str
     vendor: str
+    fallback_to_pending: bool = False  # demo mode: use any approved/pending requisition if req_id is unknown
 
 @app.post("/purchase-orders")
-def create_po(po: POCreate):
+async def create_po(po: POCreate, now: datetime = Depends(now_utc)):
     # Fetch req items
-    req = db["requisition"].find_one({"_id": {"$exists": True}, "req_id": po.req_id}) or db["requisition"].find_one({"status": {"$in": ["approved", "pending"]}})
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    oid = _requisition_oid(po.req_id)
+    req = await db["requisition"].find_one({"_id": oid}) if oid is not None else None
+    if not req and po.fallback_to_pending:
+        req = await db["requisition"].find_one({"status": {"$in": ["approved", "pending"]}})
     if not req:
         raise HTTPException(status_code=404, detail="Requisition not found")
     po_doc = PurchaseOrder(req_id=po.req_id, po_number=po.po_number, vendor=po.vendor, items=req.get("items", []), status="pending_finance")
-    pid = create_document("purchaseorder", po_doc)
-    db["requisition"].update_one({"_id": req["_id"]}, {"$set": {"status": "po_created", "updated_at": datetime.now(timezone.utc)}})
+    pid = await create_document("purchaseorder", po_doc)
+    await db["requisition"].update_one({"_id": req["_id"]}, {"$set": {"status": "po_created", "updated_at": now}})
     return {"id": pid, "po_number": po.po_number}
 
 
 # ------------- Logistics & Tracking -------------
 @app.post("/shipments/start")
-def start_shipment(po_number: str):
-    s = Shipment(po_number=po_number, status="dispatched", last_location=ShipmentLocation(lat=28.6139, lng=77.2090, temp_c=4.0, timestamp=datetime.now(timezone.utc)))
-    sid = create_document("shipment", s)
+async def start_shipment(po_number: str, now: datetime = Depends(now_utc)):
+    s = Shipment(po_number=po_number, status="dispatched", last_location=ShipmentLocation(lat=28.6139, lng=77.2090, temp_c=4.0, timestamp=now))
+    sid = await create_document("shipment", s)
     return {"id": sid, "status": s.status}
 
 @app.get("/shipments/{po_number}/track")
-def track_shipment(po_number: str):
+async def track_shipment(po_number: str, now: datetime = Depends(now_utc)):
     # Simulate GPS drift + cold chain monitoring
-    base = db["shipment"].find_one({"po_number": po_number}) if db else None
+    base = await db["shipment"].find_one({"po_number": po_number}) if db is not None else None
     lat, lng, temp = 28.6139, 77.2090, 4.0
     if base and base.get("last_location"):
         lat = base["last_location"].get("lat", lat)
@@ -312,7 +486,7 @@ def track_shipment(po_number: str):
     lat += random.uniform(-0.02, 0.02)
     lng += random.uniform(-0.02, 0.02)
     temp += random.uniform(-0.5, 0.7)
-    location = {"lat": round(lat, 5), "lng": round(lng, 5), "temp_c": round(temp, 2), "timestamp": datetime.now(timezone.utc)}
+    location = {"lat": round(lat, 5), "lng": round(lng, 5), "temp_c": round(temp, 2), "timestamp": now}
     alert = None
     if temp < 2.0 or temp > 8.0:
         alert = "Temperature excursion detected"
@@ -321,8 +495,8 @@ def track_shipment(po_number: str):
 
 # ------------- Inventory -------------
 @app.get("/inventory/low-stock")
-def low_stock():
-    items = list(db["inventoryitem"].find({"qty": {"$lt": 10}}, {"_id": 0})) if db else []
+async def low_stock():
+    items = await db["inventoryitem"].find({"qty": {"$lt": 10}}, {"_id": 0}).batch_size(_LIST_BATCH_SIZE).to_list(None) if db is not None else []
     return {"items": items}
 
 class ConsumeRequest(BaseModel):
@@ -330,20 +504,20 @@ class ConsumeRequest(BaseModel):
     qty: int
 
 @app.post("/inventory/consume")
-def consume(req: ConsumeRequest):
+async def consume(req: ConsumeRequest, now: datetime = Depends(now_utc)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    db["inventoryitem"].update_one({"sku": req.sku}, {"$inc": {"qty": -abs(req.qty)}, "$set": {"updated_at": datetime.now(timezone.utc)}}, upsert=True)
-    item = db["inventoryitem"].find_one({"sku": req.sku}, {"_id": 0})
+    await db["inventoryitem"].update_one({"sku": req.sku}, {"$inc": {"qty": -abs(req.qty)}, "$set": {"updated_at": now}}, upsert=True)
+    item = await db["inventoryitem"].find_one({"sku": req.sku}, {"_id": 0})
     return {"item": item}
 
 @app.post("/inventory/forecast")
-def forecast(req: ForecastRequest) -> ForecastResponse:
+async def forecast(req: ForecastRequest) -> ForecastResponse:
     # Simple moving average + safety stock (1 stddev)
     data = req.last_30d_consumption or [random.randint(0, 5) for _ in range(30)]
-    avg = sum(data) / len(data)
-    variance = sum((x - avg) ** 2 for x in data) / len(data)
-    stddev = math.sqrt(variance)
+    arr = np.asarray(data, dtype=np.float64)
+    avg = float(arr.mean())
+    stddev = float(arr.std())
     safety = max(2, int(round(stddev)))
     lead_time_days = 7
     reorder_point = int(round(avg * lead_time_days + safety))
@@ -352,31 +526,71 @@ def forecast(req: ForecastRequest) -> ForecastResponse:
 
 
 # ------------- Finance -------------
+# GST-inclusive invoice total for invoices stored before total_amount was denormalized;
+# same arithmetic as _invoice_total (net + net * gst / 100 per line, rounded to paise)
+_LINE_TOTAL = {"$let": {
+    "vars": {"net": {"$multiply": [{"$ifNull": ["$$this.qty", 0]}, {"$ifNull": ["$$this.price", 0]}]}},
+    "in": {"$add": ["$$net", {"$multiply": ["$$net", {"$divide": [{"$ifNull": ["$$this.gst_rate", 0]}, 100]}]}]},
+}}
+_TOTAL_FROM_ITEMS = {"$round": [{"$reduce": {
+    "input": {"$ifNull": ["$items", []]},
+    "initialValue": 0,
+    "in": {"$add": ["$$value", _LINE_TOTAL]},
+}}, 2]}
+
+def _invoice_total(items: List[InvoiceItem]) -> float:
+    total = 0.0
+    for it in items:
+        net = it.qty * it.price
+        total += net + net * (it.gst_rate / 100.0)
+    return round(total, 2)
+
 @app.post("/invoices")
-def create_invoice(inv: Invoice):
-    iid = create_document("invoice", inv)
+async def create_invoice(inv: Invoice):
+    doc = inv.model_dump()
+    # Stored once so payments can read the total without re-summing items
+    doc["total_amount"] = _invoice_total(inv.items)
+    try:
+        iid = await create_document("invoice", doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Invoice number already exists")
     return {"id": iid}
 
 @app.post("/payments")
-def add_payment(p: Payment):
-    pid = create_document("payment", p)
+async def add_payment(p: Payment, now: datetime = Depends(now_utc)):
+    pid = await create_document("payment", p)
     # update invoice status (simplified)
     if db is not None:
-        inv = db["invoice"].find_one({"invoice_no": p.invoice_no})
+        inv = await db["invoice"].find_one({"invoice_no": p.invoice_no}, {"total_amount": 1})
         if inv:
-            paid = sum(x.get("amount", 0) for x in db["payment"].find({"invoice_no": p.invoice_no}))
-            total = 0.0
-            for it in inv.get("items", []):
-                total += it.get("qty", 0) * it.get("price", 0)
-                total += (it.get("qty", 0) * it.get("price", 0)) * (it.get("gst_rate", 0) / 100.0)
-            status = "paid" if paid >= total else ("partial" if paid > 0 else "unpaid")
-            db["invoice"].update_one({"_id": inv["_id"]}, {"$set": {"status": status, "updated_at": datetime.now(timezone.utc)}})
+            update: Dict[str, Any] = {"updated_at": now}
+            total = inv.get("total_amount")
+            if total is None:
+                rows = await db["invoice"].aggregate([
+                    {"$match": {"_id": inv["_id"]}},
+                    {"$project": {"total": _TOTAL_FROM_ITEMS}},
+                ]).to_list(1)
+                total = rows[0]["total"] if rows else 0.0
+                update["total_amount"] = total
+            paid_rows = await db["payment"].aggregate([
+                {"$match": {"invoice_no": p.invoice_no}},
+                {"$group": {"_id": None, "paid": {"$sum": "$amount"}}},
+            ]).to_list(1)
+            paid = round(paid_rows[0]["paid"], 2) if paid_rows else 0
+            update["status"] = "paid" if paid >= total else ("partial" if paid > 0 else "unpaid")
+            await db["invoice"].update_one({"_id": inv["_id"]}, {"$set": update})
     return {"id": pid}
 
-@app.get("/finance/kpis")
-def finance_kpis():
-    inv_count = db["invoice"].count_documents({}) if db else 0
-    overdue = db["invoice"].count_documents({"status": "overdue"}) if db else 0
+@app.get("/finance/kpis", dependencies=[Depends(cache_control(30))])
+@ttl_cached("finance_kpis", ttl=30)
+async def finance_kpis():
+    if db is not None:
+        inv_count, overdue = await asyncio.gather(
+            db["invoice"].estimated_document_count(),
+            db["invoice"].count_documents({"status": "overdue"}),
+        )
+    else:
+        inv_count = overdue = 0
     payables = inv_count - overdue
     credit_limit = 1000000
     used_credit = random.randint(200000, 600000)
@@ -384,41 +598,45 @@ def finance_kpis():
 
 
 # ------------- Compliance -------------
-@app.get("/compliance")
-def compliance_list():
-    items = list(db["compliancedoc"].find({}, {"_id": 0})) if db else []
+@app.get("/compliance", dependencies=[Depends(cache_control(300))])
+@ttl_cached("compliance", ttl=300)
+async def compliance_list():
+    items = await db["compliancedoc"].find({}, {"_id": 0}).batch_size(_LIST_BATCH_SIZE).to_list(None) if db is not None else []
     if not items:
         seed = [
             ComplianceDoc(title="Method validation records", std="NABL", status="in_progress", owner="qa@lab.com"),
             ComplianceDoc(title="Equipment calibration schedule", std="ISO15189", status="pending", owner="biomed@lab.com"),
         ]
-        for d in seed:
-            try:
-                create_document("compliancedoc", d)
-            except Exception:
-                pass
+        await _seed_missing("compliancedoc", "title", seed)
         items = [d.model_dump() for d in seed]
     return {"items": items}
 
 
 # ------------- AI Assistant (Simulated Gemini) -------------
-@app.post("/ai/ask")
-def ai_ask(msg: ChatMessage):
-    # Simulate helpful response grounded on requested module
-    hints = {
-        "inventory": "Current low stock items can be reviewed in Inventory > Alerts. Consider reordering high ABC-class reagents first.",
-        "finance": "Net 30 invoices due this week total INR 2.4L. Paying early could save ~2% in discounts.",
-        "lims": "3 samples have abnormal results awaiting validation in Biochemistry.",
-        "procurement": "Two requisitions are pending approval. Recommended vendor for glucose reagent is ChemLabs.",
-    }
-    key = next((k for k in hints if k in msg.content.lower()), "lims")
-    answer = f"Insight: {hints[key]}\nYou asked: {msg.content[:300]}"
-    # store conversation
+_HINTS = {
+    "inventory": "Current low stock items can be reviewed in Inventory > Alerts. Consider reordering high ABC-class reagents first.",
+    "finance": "Net 30 invoices due this week total INR 2.4L. Paying early could save ~2% in discounts.",
+    "lims": "3 samples have abnormal results awaiting validation in Biochemistry.",
+    "procurement": "Two requisitions are pending approval. Recommended vendor for glucose reagent is ChemLabs.",
+}
+# One case-insensitive pass over the message instead of a lowercase copy + a scan per key
+_HINT_RE = re.compile("(" + "|".join(map(re.escape, _HINTS)) + ")", re.IGNORECASE)
+
+async def _store_conversation(msg: ChatMessage, answer: str):
     try:
-        create_document("chatmessage", msg)
-        create_document("chatmessage", ChatMessage(role="assistant", content=answer, context="auto"))
+        await create_documents("chatmessage", [msg, ChatMessage(role="assistant", content=answer, context="auto")])
     except Exception:
-        pass
+        # runs after the response is sent, so the log is the only place this can surface
+        logger.exception("Failed to store chat messages")
+
+@app.post("/ai/ask")
+async def ai_ask(msg: ChatMessage, background: BackgroundTasks):
+    # Simulate helpful response grounded on requested module
+    m = _HINT_RE.search(msg.content)
+    key = m.group(1).lower() if m else "lims"
+    answer = f"Insight: {_HINTS[key]}\nYou asked: {msg.content[:300]}"
+    # store conversation after the response is sent
+    background.add_task(_store_conversation, msg, answer)
     return {"answer": answer}
 
 